@@ -4,8 +4,14 @@ import opuslib
 import socket
 import threading
 import sys
+import os
+import queue
 import time
+import ctypes
+import ctypes.util
+import struct
 import opuslib.api.encoder as encoder_api
+import opuslib.api.decoder as decoder_api
 
 # ==========================================================
 # --- OPUS CONSTANTS (from opus_defines.h) ---
@@ -34,6 +40,8 @@ CHANNELS = 1              # Mono audio
 FRAME_DURATION_MS = 20    # 20ms per frame (standard for real-time VoIP)
 FRAME_SIZE = (SAMPLING_RATE // 1000) * FRAME_DURATION_MS  # 320 samples/frame
 RECORD_SECONDS = 1        # Record 1 second of audio per push-to-talk
+FRAMES_PER_PRESS = (RECORD_SECONDS * SAMPLING_RATE) // FRAME_SIZE  # 50 frames
+MAX_PACKET_BYTES = 4000   # Upper bound for one encoded Opus packet (libopus recommendation)
 
 # ==========================================================
 # --- GLOBAL ENCODER STATE ---
@@ -43,9 +51,262 @@ CURRENT_USE_FEC = False       # Forward Error Correction disabled by default
 CURRENT_COMPLEXITY = 5        # Opus complexity (0–10)
 encoder = None                # Will be initialized in main()
 
+# ==========================================================
+# --- BATCHED UDP I/O (Linux sendmmsg/recvmmsg) ---
+# One sendmmsg() syscall pushes a whole push-to-talk burst
+# instead of one sendto() per 20ms frame; recvmmsg() drains
+# every queued packet per wakeup on the receive side.
+# ==========================================================
+SENDMMSG_MAX_BATCH = 100      # Max datagrams handed to the kernel per call
+RECVMMSG_MAX_BATCH = 32       # Max datagrams drained per receive call
+RECV_SLOT_BYTES = 1500        # One MTU-sized receive slot per datagram
+MSG_WAITFORONE = 0x10000      # recvmmsg(): block for the first datagram only
+UDP_SEGMENT = 103             # Linux UDP GSO socket option (<linux/udp.h>)
+GSO_MAX_SEGMENTS = 64         # Kernel limit on segments per GSO send
+GSO_MAX_BYTES = 65000         # Stay under the 64 KiB UDP payload limit
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except (OSError, TypeError):
+        return None
+
+
+_libc = _load_libc()
+# None on macOS/Windows -> send_batch() falls back to sendto()
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+_recvmmsg = getattr(_libc, "recvmmsg", None)
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+
+# ==========================================================
+# --- UDP SOCKET TUNING ---
+# ==========================================================
+SOCKET_BUFFER_BYTES = 4 * 1024 * 1024  # Absorb packet bursts without kernel drops
+IP_MTU_DISCOVER = 10          # Linux <netinet/in.h> (not exported by the socket module)
+IP_PMTUDISC_DO = 2            # Always set DF: never fragment an Opus packet
+
+
+def tune_udp_socket(sock: socket.socket, option: int):
+    """
+    Enlarges the socket's send or receive buffer (option is SO_SNDBUF or
+    SO_RCVBUF) and, on Linux, disables IP fragmentation.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_BYTES)
+    except OSError as e:
+        print(f"Warning: Could not enlarge socket buffer: {e}")
+    else:
+        # The kernel silently caps the request (net.core.rmem_max / wmem_max)
+        actual = sock.getsockopt(socket.SOL_SOCKET, option)
+        if actual < SOCKET_BUFFER_BYTES:
+            name = "rmem_max" if option == socket.SO_RCVBUF else "wmem_max"
+            print(f"Note: Socket buffer capped at {actual} bytes (raise net.core.{name} for more).")
+
+    if sys.platform.startswith("linux"):
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        except OSError:
+            pass
+
+
+def _sockaddr_in(addr):
+    """Packs a (host, port) tuple into a raw struct sockaddr_in buffer."""
+    host, port = addr
+    raw = (
+        socket.AF_INET.to_bytes(2, sys.byteorder)   # sin_family (host order)
+        + port.to_bytes(2, "big")                   # sin_port (network order)
+        + socket.inet_aton(socket.gethostbyname(host))
+        + bytes(8)                                  # sin_zero
+    )
+    return ctypes.create_string_buffer(raw, len(raw))
+
+
+# Cleared after the first GSO send the kernel rejects (e.g. pre-4.18)
+_gso_supported = sys.platform.startswith("linux")
+
+
+def _send_gso(sock, packets, addr) -> bool:
+    """
+    Sends packets with UDP GSO: one sendmsg() per group of up to
+    GSO_MAX_SEGMENTS packets, split by the kernel into equal-size
+    datagrams. GSO needs equal segments, so every packet is first grown
+    to the group's largest size with opus_packet_pad(). That is Opus's own
+    padding, which the receiving decoder ignores, so no wire framing changes.
+    Returns False if GSO is unavailable and nothing was sent.
+    """
+    global _gso_supported
+    pad = opuslib.api.libopus.opus_packet_pad
+    offset = 0
+    while offset < len(packets):
+        segment = max(len(p) for p in packets[offset:offset + GSO_MAX_SEGMENTS])
+        count = min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // segment, len(packets) - offset)
+        segment = max(len(p) for p in packets[offset:offset + count])
+
+        buffer = (ctypes.c_char * (segment * count))()
+        base = ctypes.addressof(buffer)
+        for i, packet in enumerate(packets[offset:offset + count]):
+            ctypes.memmove(base + i * segment, packet, len(packet))
+            if len(packet) < segment and pad(ctypes.c_void_p(base + i * segment), len(packet), segment) != 0:
+                raise opuslib.OpusError(-1)
+
+        try:
+            sock.sendmsg([buffer], [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment))], 0, addr)
+        except OSError:
+            if offset:
+                raise
+            _gso_supported = False
+            return False
+        offset += count
+    return True
+
+
+def _send_mmsg(sock, packets, addr):
+    """Sends packets with one sendmmsg() call per SENDMMSG_MAX_BATCH packets."""
+    name = _sockaddr_in(addr)
+    for offset in range(0, len(packets), SENDMMSG_MAX_BATCH):
+        batch = packets[offset:offset + SENDMMSG_MAX_BATCH]
+        count = len(batch)
+        iovecs = (_IOVec * count)()
+        msgs = (_MMsgHdr * count)()
+        for i, packet in enumerate(batch):
+            # c_char_p points straight at the bytes object's buffer (no copy)
+            iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p)
+            iovecs[i].iov_len = len(packet)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(name)
+            hdr.msg_namelen = len(name)
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+
+        sent = 0
+        while sent < count:
+            pending = ctypes.cast(ctypes.addressof(msgs[sent]), ctypes.POINTER(_MMsgHdr))
+            result = _sendmmsg(sock.fileno(), pending, count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            sent += result
+
+
+def send_batch(sock, packets, addr):
+    """
+    Sends a list of encoded packets to addr in as few syscalls as the
+    platform allows: UDP GSO, then sendmmsg(), then one sendto() each.
+    """
+    if sock.family == socket.AF_INET and len(packets) > 1:
+        if _gso_supported and _send_gso(sock, packets, addr):
+            return
+        if _sendmmsg is not None:
+            _send_mmsg(sock, packets, addr)
+            return
+
+    for packet in packets:
+        sock.sendto(packet, addr)
+
+
+def _make_recv_slots():
+    """
+    Allocates the persistent recvmmsg() state: RECVMMSG_MAX_BATCH headers,
+    each pointing at its own slot of one contiguous receive buffer.
+    """
+    buffer = (ctypes.c_char * (RECVMMSG_MAX_BATCH * RECV_SLOT_BYTES))()
+    iovecs = (_IOVec * RECVMMSG_MAX_BATCH)()
+    msgs = (_MMsgHdr * RECVMMSG_MAX_BATCH)()
+    base = ctypes.addressof(buffer)
+    for i in range(RECVMMSG_MAX_BATCH):
+        iovecs[i].iov_base = base + i * RECV_SLOT_BYTES
+        iovecs[i].iov_len = RECV_SLOT_BYTES
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return buffer, iovecs, msgs
+
+
+def recv_batch(sock, slots):
+    """
+    Blocks until at least one datagram arrives, then returns every queued
+    datagram (up to RECVMMSG_MAX_BATCH) as (c_char_p, length) pairs that
+    point into the receive slots. Falls back to a single recvfrom().
+    """
+    if _recvmmsg is None:
+        packet, addr = sock.recvfrom(RECV_SLOT_BYTES)
+        return [(packet, len(packet))]
+
+    buffer, iovecs, msgs = slots
+    count = _recvmmsg(sock.fileno(), msgs, RECVMMSG_MAX_BATCH, MSG_WAITFORONE, None)
+    if count < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return [
+        (ctypes.cast(iovecs[i].iov_base, ctypes.c_char_p), msgs[i].msg_len)
+        for i in range(count)
+    ]
+
 # ==========================================================
 # --- FUNCTIONS ---
 # ==========================================================
+def _cpu_simd_flags() -> set:
+    """Returns the SIMD extensions relevant to libopus that this CPU reports (Linux only)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return set()
+    return flags & {"sse4_1", "avx2", "fma", "neon", "asimd"}
+
+
+def check_opus_build():
+    """
+    Logs the linked libopus version and warns about builds that will
+    run the slow scalar/fixed-point code paths.
+    """
+    try:
+        get_version = opuslib.api.libopus.opus_get_version_string
+        get_version.restype = ctypes.c_char_p
+        version = get_version().decode()
+    except Exception as e:
+        print(f"Warning: Could not query libopus version: {e}")
+        return
+
+    simd = _cpu_simd_flags()
+    print(f"[Opus] Linked {version} (CPU SIMD: {', '.join(sorted(simd)) or 'unknown'})")
+
+    if "-fixed" in version:
+        print("Warning: libopus is a fixed-point build; encode/decode will be slower on this CPU.")
+        print("  Rebuild it with SIMD intrinsics enabled (see README: 'Faster libopus').")
+
 def set_encoder_settings(bitrate: int, use_fec: bool, complexity: int):
     global CURRENT_BITRATE, CURRENT_USE_FEC, CURRENT_COMPLEXITY
     try:
@@ -62,6 +323,45 @@ def set_encoder_settings(bitrate: int, use_fec: bool, complexity: int):
         return False
 
 
+# Scratch output buffer shared by every encode call. Only one thread
+# encodes at a time (the sender thread, or main() in synthetic mode).
+_encode_scratch = (ctypes.c_char * MAX_PACKET_BYTES)()
+_encode_view = memoryview(_encode_scratch)
+
+
+def _encode_frame(pcm_address: int) -> int:
+    """Encodes one frame at pcm_address into _encode_scratch; returns the packet length."""
+    pcm = ctypes.cast(pcm_address, opuslib.api.c_int16_pointer)
+    result = encoder_api.libopus_encode(
+        encoder.encoder_state, pcm, FRAME_SIZE, _encode_scratch, MAX_PACKET_BYTES
+    )
+    if result < 0:
+        raise opuslib.OpusError(result)
+    return result
+
+
+def encode_frames(audio_data: np.ndarray) -> list:
+    """
+    Encodes a recorded int16 buffer into a list of 20ms Opus packets.
+
+    libopus is called directly on pointers into the NumPy buffer, so no
+    per-frame bytes copy is made and one output buffer is reused.
+    """
+    # Frame pointers are computed from raw byte offsets, which is only
+    # valid for a contiguous int16 buffer (what sd.rec() returns).
+    if audio_data.dtype != np.int16 or not audio_data.flags['C_CONTIGUOUS']:
+        raise ValueError("encode_frames() expects a C-contiguous int16 buffer")
+
+    num_frames = len(audio_data) // FRAME_SIZE
+    frame_bytes = FRAME_SIZE * CHANNELS * audio_data.itemsize
+    base = audio_data.ctypes.data
+
+    packets = []
+    for i in range(num_frames):
+        length = _encode_frame(base + i * frame_bytes)
+        packets.append(ctypes.string_at(_encode_scratch, length))
+    return packets
+
 
 def audio_receiver(listen_port: int):
     """
@@ -81,6 +381,7 @@ def audio_receiver(listen_port: int):
         return
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_udp_socket(sock, socket.SO_RCVBUF)
     try:
         sock.bind(('0.0.0.0', listen_port))
     except OSError as e:
@@ -89,24 +390,63 @@ def audio_receiver(listen_port: int):
         
     print(f"\n[Receiver] Listening on port {listen_port}...")
 
+    # Decode straight into one persistent PCM buffer; the OutputStream
+    # reads it through the buffer protocol, so no per-packet bytes object.
+    # It holds one decoded frame per packet of a receive batch.
+    pcm_buffer = np.empty(RECVMMSG_MAX_BATCH * FRAME_SIZE * CHANNELS, dtype=np.int16)
+    pcm_base = pcm_buffer.ctypes.data
+    slots = _make_recv_slots() if _recvmmsg is not None else None
+
     while True:
         try:
-            packet, addr = sock.recvfrom(1024)
-            pcm_data = decoder.decode(packet, FRAME_SIZE, decode_fec=True)
-            stream.write(pcm_data)
-        except opuslib.OpusError:
-            # Ignore minor decode errors (e.g., lost/corrupt packets)
-            pass
+            num_samples = 0
+            for packet, length in recv_batch(sock, slots):
+                pcm_pointer = ctypes.cast(
+                    pcm_base + num_samples * CHANNELS * pcm_buffer.itemsize,
+                    opuslib.api.c_int16_pointer
+                )
+                result = decoder_api.libopus_decode(
+                    decoder.decoder_state, packet, length,
+                    pcm_pointer, FRAME_SIZE, 1  # decode_fec=True
+                )
+                if result < 0:
+                    # Ignore minor decode errors (e.g., lost/corrupt packets)
+                    continue
+                num_samples += result
+
+            if num_samples:
+                stream.write(pcm_buffer[:num_samples * CHANNELS])
         except Exception as e:
             print(f"Receiver Error: {e}")
 
 
+def audio_sender(frame_queue: queue.SimpleQueue, send_sock: socket.socket, dest_address):
+    """
+    Background thread that encodes captured 20ms frames and sends
+    them as they arrive. A None entry marks the end of a push-to-talk.
+    """
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            print("...Sending complete.")
+            print("\nPress ENTER to talk for 1 second...")
+            continue
+        try:
+            # Send straight out of the scratch buffer: no per-packet bytes object
+            length = _encode_frame(frame.ctypes.data)
+            send_sock.sendto(_encode_view[:length], dest_address)
+        except Exception as e:
+            print(f"Sender Error: {e}")
+
+
 def main(my_port: int, dest_port: int):
     """
     The main Push-to-Talk function.
     """
     global encoder
-    
+
+    check_opus_build()
+
     try:
         encoder = opuslib.Encoder(SAMPLING_RATE, CHANNELS, opuslib.APPLICATION_VOIP)
         set_encoder_settings(CURRENT_BITRATE, CURRENT_USE_FEC, CURRENT_COMPLEXITY)
@@ -124,7 +464,43 @@ def main(my_port: int, dest_port: int):
 
     # Set up UDP sending socket
     send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_udp_socket(send_sock, socket.SO_SNDBUF)
     dest_address = ('127.0.0.1', dest_port)
+
+    # Capture runs continuously; the callback only forwards frames while
+    # a push-to-talk is active, so encoding and sending overlap recording.
+    frame_queue = queue.SimpleQueue()
+    frames_left = 0
+
+    def on_audio(indata, frames, time_info, status):
+        nonlocal frames_left
+        if frames_left <= 0:
+            return
+        frame_queue.put(indata.copy())
+        frames_left -= 1
+        if frames_left == 0:
+            frame_queue.put(None)
+
+    try:
+        in_stream = sd.InputStream(
+            samplerate=SAMPLING_RATE,
+            channels=CHANNELS,
+            dtype='int16',
+            blocksize=FRAME_SIZE,
+            callback=on_audio
+        )
+        in_stream.start()
+    except sd.PortAudioError as e:
+        print(f"Error: No audio input device found. {e}")
+        print("Each press will send 1s of synthetic noise to test the pipeline.")
+        in_stream = None
+    else:
+        sender_thread = threading.Thread(
+            target=audio_sender,
+            args=(frame_queue, send_sock, dest_address),
+            daemon=True
+        )
+        sender_thread.start()
     
     print(f"\n[Sender] Ready. Sending to port {dest_port}.")
     print("Press ENTER to talk for 1 second...")
@@ -134,28 +510,16 @@ def main(my_port: int, dest_port: int):
             input()  # Wait for Enter key
             print(f"Recording... (Bitrate: {CURRENT_BITRATE}bps, FEC: {CURRENT_USE_FEC})")
 
-            try:
-                audio_data = sd.rec(
-                    frames=int(RECORD_SECONDS * SAMPLING_RATE),
-                    samplerate=SAMPLING_RATE,
-                    channels=CHANNELS,
-                    dtype='int16'
-                )
-                sd.wait()
-            except sd.PortAudioError as e:
-                print(f"Error: No audio input device found. {e}")
-                print("Generating 1s of synthetic noise to test the pipeline...")
-                audio_data = (np.random.rand(int(RECORD_SECONDS * SAMPLING_RATE), 1) * 1000).astype('int16')
-
-            # Send audio in 20ms frames
-            num_frames = len(audio_data) // FRAME_SIZE
-            for i in range(num_frames):
-                start = i * FRAME_SIZE
-                end = start + FRAME_SIZE
-                pcm_frame = audio_data[start:end].tobytes()
-
-                encoded_packet = encoder.encode(pcm_frame, FRAME_SIZE)
-                send_sock.sendto(encoded_packet, dest_address)
+            if in_stream is not None:
+                # The capture callback and sender thread take it from here
+                frames_left = FRAMES_PER_PRESS
+                continue
+
+            audio_data = (np.random.rand(int(RECORD_SECONDS * SAMPLING_RATE), 1) * 1000).astype('int16')
+
+            # Encode audio in 20ms frames, then send the burst in one batch
+            packets = encode_frames(audio_data)
+            send_batch(send_sock, packets, dest_address)
 
             print("...Sending complete.")
             print("\nPress ENTER to talk for 1 second...")
@@ -166,6 +530,9 @@ def main(my_port: int, dest_port: int):
         except Exception as e:
             print(f"Main Loop Error: {e}")
 
+    if in_stream is not None:
+        in_stream.close()
+
 
 # ==========================================================
 # --- ENTRY POINT ---
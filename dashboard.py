@@ -1,6 +1,6 @@
 import streamlit as st
 from pathlib import Path
-from dashboard_engine import run_audio_simulation, load_model
+from dashboard_engine import run_controllers_parallel, make_controller_pool, load_model
 
 
 st.set_page_config(page_title="Adaptive Opus Dashboard", layout="wide")
@@ -13,7 +13,19 @@ st.markdown("Upload an audio file (wav/flac). The app will run four controllers
 uploaded = st.file_uploader("Upload audio (.wav or .flac)", type=["wav", "flac"])
 packet_loss = st.slider("Simulated packet loss (%)", min_value=0.0, max_value=20.0, value=2.0, step=0.5)
 
-model = load_model()
+@st.cache_resource
+def get_controller_pool():
+    # Started once per server: the workers load the model when they start,
+    # not on every click (restart the app after retraining)
+    return make_controller_pool()
+
+
+@st.cache_resource
+def get_model():
+    return load_model()
+
+
+model = get_model()
 if model is None:
     st.warning("ML model not found or failed to load. 'ML-Adaptive' and 'Hybrid' will use fallback behavior.")
 
@@ -33,10 +45,13 @@ if uploaded is not None:
         tabs = st.tabs(["Static", "Heuristic", "ML-Adaptive", "Hybrid"])
         controllers = ["static", "heuristic", "ml_adaptive", "hybrid"]
 
+        # The controllers are independent, so run them side by side
+        with st.spinner("Running: " + ", ".join(controllers)):
+            results = run_controllers_parallel(tmp_path, packet_loss, controllers, get_controller_pool())
+
         for tab, ctrl in zip(tabs, controllers):
             with tab:
-                st.write(f"Running: {ctrl}")
-                metrics = run_audio_simulation(tmp_path, packet_loss, ctrl, model)
+                metrics = results[ctrl]
                 if not metrics:
                     st.error("Simulation failed for this controller.")
                     continue
@@ -1,24 +1,33 @@
 import time
+import multiprocessing
+from math import gcd
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import joblib
 import numpy as np
 import soundfile as sf
-from scipy.signal import resample
+from scipy.signal import resample_poly
 
-from opus_wrapper import process_audio_file, PROCESSED_AUDIO_DIR, BASE_PROJECT_DIR
+from opus_wrapper import process_audio_pcm
 from quality_analyzer import get_audio_quality
 
 
 # Paths
 BASE_DIR = Path.home() / "adaptive_opus"
 MODEL_PATH = BASE_DIR / "qoe_model.joblib"
+# HistGradientBoosting variant written by generate_final_report.py
+HGB_MODEL_PATH = BASE_DIR / "qoe_model_hgb.joblib"
+# ONNX export written by train_model.py (used when onnxruntime is installed)
+ONNX_MODEL_PATH = BASE_DIR / "qoe_model.onnx"
 
 
 def resample_to_16khz(audio, sr):
     if sr == 16000:
         return audio, sr
-    num_samples = int(len(audio) * 16000 / sr)
-    audio_res = resample(audio, num_samples)
+    # Polyphase FIR resampling (e.g. 44.1kHz -> 16kHz is up=160, down=441)
+    # avoids the full-length FFTs of scipy.signal.resample.
+    g = gcd(sr, 16000)
+    audio_res = resample_poly(audio, 16000 // g, sr // g)
     return audio_res, 16000
 
 
@@ -42,6 +51,15 @@ def generate_all_configs():
     return configs
 
 
+# The candidate grid is constant: build it, and its feature template
+# ([bitrate, frame_size, use_fec, packet_loss_perc]), once at import.
+_ALL_CONFIGS = tuple(generate_all_configs())
+_FEAT_TEMPLATE = np.array(
+    [[cfg["bitrate"], cfg["frame_size"], int(cfg["use_fec"]), 0.0] for cfg in _ALL_CONFIGS],
+    dtype=np.float32
+)
+
+
 def static_controller(packet_loss):
     return {"bitrate": 32, "frame_size": 20, "complexity": 5, "use_fec": False}
 
@@ -59,22 +77,17 @@ def heuristic_controller(packet_loss):
 
 
 def ml_controller(packet_loss, model):
-    candidates = generate_all_configs()
-    best = None
-    best_score = -1e9
+    # Score every candidate with a single predict() call
+    features = _FEAT_TEMPLATE.copy()
+    features[:, 3] = packet_loss
+    try:
+        preds = model.predict(features)
+    except Exception:
+        # No usable model: fall back to the first candidate
+        return dict(_ALL_CONFIGS[0])
 
-    # Prepare feature vector according to training: [bitrate, frame_size, use_fec, packet_loss_perc]
-    for cfg in candidates:
-        features = [cfg["bitrate"], cfg["frame_size"], int(cfg["use_fec"]), packet_loss]
-        try:
-            pred = model.predict([features])[0]
-        except Exception:
-            pred = 0.0
-        if pred > best_score:
-            best_score = pred
-            best = cfg
-
-    return best
+    # Hand out a copy so callers cannot mutate the shared grid
+    return dict(_ALL_CONFIGS[int(np.argmax(preds))])
 
 
 def hybrid_controller(packet_loss, model):
@@ -99,8 +112,11 @@ def run_audio_simulation(audio_path: Path, packet_loss_perc: float, controller_t
     data_mono = data[:, 0] if data.ndim > 1 else data
     data_res, sr_res = resample_to_16khz(data_mono, sr)
 
-    temp_input = PROCESSED_AUDIO_DIR / f"temp_input_{int(time.time()*1000)}.wav"
-    sf.write(temp_input, data_res, sr_res)
+    # Keep the clean reference in memory as int16 (what a 16-bit WAV
+    # round-trip used to produce); libopus encodes it straight from memory.
+    ref_pcm = np.clip(np.rint(data_res * 32767), -32768, 32767).astype(np.int16)
+    # Controllers may run concurrently, so the name includes the controller
+    run_name = f"temp_input_{int(time.time()*1000)}_{controller_type}"
 
     # Select controller
     if controller_type == 'static':
@@ -115,22 +131,24 @@ def run_audio_simulation(audio_path: Path, packet_loss_perc: float, controller_t
         raise ValueError("Unknown controller type")
 
     # Run codec pipeline
-    processed_file = process_audio_file(
-        input_wav_path=temp_input,
+    processed_file = process_audio_pcm(
+        pcm=ref_pcm,
+        sample_rate=sr_res,
+        name=run_name,
         bitrate=cfg['bitrate'],
         frame_size=cfg['frame_size'],
         complexity=cfg['complexity'],
         use_fec=cfg['use_fec'],
-        simulated_loss_perc=packet_loss_perc
+        simulated_loss_perc=packet_loss_perc,
+        # Same loss pattern for every controller on this upload
+        loss_name=Path(audio_path).name
     )
 
     if not processed_file:
-        # Clean up
-        temp_input.unlink(missing_ok=True)
         return None
 
     # Compute PESQ
-    mos = get_audio_quality(temp_input, processed_file)
+    mos = get_audio_quality(ref_pcm, processed_file)
 
     end = time.time()
 
@@ -142,16 +160,130 @@ def run_audio_simulation(audio_path: Path, packet_loss_perc: float, controller_t
         "processed_file": processed_file
     }
 
-    # Cleanup temp input (keep processed_file for playback if needed)
-    temp_input.unlink(missing_ok=True)
-
     return metrics
 
 
+# Model used by run_controllers_parallel() workers; loaded once per worker
+# by the pool initializer instead of being pickled with every job.
+_worker_model = None
+
+
+def _init_worker():
+    global _worker_model
+    _worker_model = load_model()
+
+
+def _run_in_worker(audio_path: Path, packet_loss_perc: float, controller_type: str):
+    return run_audio_simulation(audio_path, packet_loss_perc, controller_type, _worker_model)
+
+
+def make_controller_pool(max_workers: int = 4) -> ProcessPoolExecutor:
+    """Process pool for run_controllers_parallel(); each worker loads the model once.
+
+    Meant to be created once and reused (the dashboard caches it). Workers
+    are spawned rather than forked, since the caller (the Streamlit server)
+    is multi-threaded.
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker
+    )
+
+
+def run_controllers_parallel(audio_path: Path, packet_loss_perc: float, controllers: list, pool: ProcessPoolExecutor) -> dict:
+    """Runs run_audio_simulation() for each controller on pool (see make_controller_pool).
+
+    Returns a dict of controller_type -> metrics (or None if that run failed).
+    """
+    futures = {
+        ctrl: pool.submit(_run_in_worker, audio_path, packet_loss_perc, ctrl)
+        for ctrl in controllers
+    }
+    return {ctrl: f.result() for ctrl, f in futures.items()}
+
+
+class OnnxModel:
+    """onnxruntime session exposing the sklearn-style predict() the controllers use."""
+
+    def __init__(self, path: Path):
+        import onnxruntime as ort
+        self.session = ort.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return self.session.run(None, {self.input_name: X})[0].ravel()
+
+
+class FlatForest:
+    """
+    A fitted RandomForestRegressor flattened into node arrays.
+
+    predict() advances every (row, tree) pair one level per step with NumPy
+    fancy indexing, instead of sklearn's per-tree dispatch. Leaves point to
+    themselves, so running max_depth steps lands every pair on its leaf.
+    """
+
+    def __init__(self, forest):
+        trees = [est.tree_ for est in forest.estimators_]
+        offsets = np.cumsum([0] + [t.node_count for t in trees[:-1]])
+        self.roots = offsets
+
+        features, thresholds, lefts, rights, values = [], [], [], [], []
+        for tree, offset in zip(trees, offsets):
+            nodes = np.arange(tree.node_count) + offset
+            leaf = tree.children_left == -1
+            features.append(np.where(leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(leaf, nodes, tree.children_left + offset))
+            rights.append(np.where(leaf, nodes, tree.children_right + offset))
+            values.append(tree.value[:, 0, 0])
+        self.feature = np.concatenate(features)
+        self.threshold = np.concatenate(thresholds)
+        self.left = np.concatenate(lefts)
+        self.right = np.concatenate(rights)
+        self.value = np.concatenate(values)
+        self.max_depth = max(t.max_depth for t in trees)
+
+    def predict(self, X):
+        # sklearn's trees compare float32 features against the thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(X.shape[0])[:, None]
+        node = np.repeat(self.roots[None, :], X.shape[0], axis=0)
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return self.value[node].mean(axis=1)
+
+
 def load_model():
-    if MODEL_PATH.exists():
+    """
+    Loads the most recently written model. train_model.py writes
+    qoe_model.joblib and then its ONNX export; generate_final_report.py
+    writes qoe_model_hgb.joblib. Picking by mtime means an older file never
+    shadows a retrain, and the ONNX export wins over its own joblib. It also
+    means running the report after train_model.py switches the dashboard to
+    the report's HGB model; rerun train_model.py to switch back.
+    """
+    candidates = [p for p in (ONNX_MODEL_PATH, HGB_MODEL_PATH, MODEL_PATH) if p.exists()]
+    candidates.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+
+    for path in candidates:
+        if path == ONNX_MODEL_PATH:
+            try:
+                return OnnxModel(path)
+            except Exception as e:
+                # onnxruntime missing or bad file: fall back to the joblib models
+                print(f"Could not load model {path.name}: {e}")
+                continue
         try:
-            return joblib.load(MODEL_PATH)
-        except Exception:
-            return None
+            model = joblib.load(path)
+        except Exception as e:
+            print(f"Could not load model {path.name}: {e}")
+            continue
+        from sklearn.ensemble import RandomForestRegressor
+        if isinstance(model, RandomForestRegressor):
+            return FlatForest(model)
+        return model
     return None
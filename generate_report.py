@@ -24,14 +24,12 @@ def plot_mean_mos(df):
 
 
 def plot_mos_vs_loss(df):
-    import numpy as np
-    controllers = df['controller'].unique()
+    # mean MOS at each loss, one column per controller (in order of appearance)
+    wide = df.groupby(['packet_loss_perc', 'controller'])['mos'].mean().unstack('controller')
+    wide = wide[df['controller'].unique()]
+    wide.index = wide.index.astype(float)
     fig, ax = plt.subplots(figsize=(8,5))
-    for c in controllers:
-        sub = df[df['controller']==c]
-        # compute mean at each loss
-        grp = sub.groupby('packet_loss_perc')['mos'].mean().sort_index()
-        ax.plot(grp.index.astype(float), grp.values, marker='o', label=c)
+    wide.plot(marker='o', ax=ax)
     ax.set_xlabel('Packet loss (%)')
     ax.set_ylabel('Mean MOS')
     ax.set_title('MOS vs Packet Loss by Controller')
@@ -45,12 +43,7 @@ def plot_mos_vs_loss(df):
 
 
 def top2_per_input(df):
-    rows = []
-    for inp, g in df.groupby('input_file'):
-        best = g.sort_values('mos', ascending=False).head(2)
-        for _, r in best.iterrows():
-            rows.append(r)
-    return pd.DataFrame(rows)
+    return df.sort_values(['input_file', 'mos'], ascending=[True, False]).groupby('input_file').head(2)
 
 
 def main():
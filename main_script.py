@@ -1,13 +1,20 @@
-import pandas as pd
+import csv
+import numpy as np
+import soundfile as sf
 from pathlib import Path
 from tqdm import tqdm
 import multiprocessing
+from multiprocessing import shared_memory
 import atexit
+import shelve
 import warnings
 
 # Import our helper functions from the other files
-from opus_wrapper import process_audio_file, CLEAN_AUDIO_DIR, PROCESSED_AUDIO_DIR, BASE_PROJECT_DIR
-from quality_analyzer import get_audio_quality
+from opus_wrapper import process_audio_pcm, list_flacs, pin_worker, CLEAN_AUDIO_DIR, PROCESSED_AUDIO_DIR, BASE_PROJECT_DIR
+from quality_analyzer import (
+    get_audio_quality, skip_stats, REQUIRED_SAMPLE_RATE,
+    SNR_GATE_ENABLED, SNR_SKIP_LOW_DB, SNR_SKIP_HIGH_DB,
+)
 
 # ----------------------------------------------------------------------------
 # 💡 PARAMETER SWEEP (FOR 10k SAMPLES) 💡
@@ -31,6 +38,32 @@ FEC_STATUSES = [True, False]
 # Simulated Packet Loss Percentages
 PACKET_LOSSES = [0, 1, 2, 3, 5, 7, 10]
 
+# Columns of opus_dataset.csv, in order
+DATASET_COLUMNS = [
+    "original_file", "bitrate", "frame_size", "complexity",
+    "use_fec", "packet_loss_perc", "pesq_mos_score"
+]
+
+# Rows buffered per Parquet row group
+PARQUET_ROW_GROUP_ROWS = 50_000
+
+# Finished rows from earlier runs, keyed by combination. Packet loss is
+# seeded per combination, so a rerun (or an aborted one) resumes from here
+# instead of starting over. Delete the file(s) to recompute everything.
+# Bump CACHE_VERSION whenever the loss seeding, the codec path or the
+# scoring changes. The version and the SNR gate thresholds are part of the
+# file name, so rows computed under other settings are never reused.
+CACHE_VERSION = 2
+SCORE_CACHE_PATH = BASE_PROJECT_DIR / (
+    f"score_cache_v{CACHE_VERSION}_snr{SNR_SKIP_LOW_DB:g}_{SNR_SKIP_HIGH_DB:g}"
+)
+# Columns that identify one combination (everything but the score)
+COMBINATION_COLUMNS = DATASET_COLUMNS[:-1]
+
+
+def combination_key(row: dict) -> str:
+    return "|".join(str(row[name]) for name in COMBINATION_COLUMNS)
+
 # --- Global Pool for cleanup ---
 # We'll create a global pool to be able to close it on exit
 pool = None
@@ -47,50 +80,128 @@ def cleanup_pool():
 # Register the cleanup function to be called on script exit
 atexit.register(cleanup_pool)
 
+
+# --- Shared source audio ---
+# Each source file is decoded once in the parent into a SharedMemory block
+# of raw int16 PCM; workers map it instead of re-reading the .flac per job.
+_attached_sources = {}  # Per-worker cache: shm name -> (SharedMemory, ndarray)
+
+
+def share_source_audio(audio_file: Path) -> tuple[shared_memory.SharedMemory, dict] | None:
+    """
+    Decodes one source file into a new SharedMemory block.
+    Returns the block (owned by the caller) and the job "source" descriptor,
+    or None if the file cannot be used.
+    """
+    try:
+        data, sr = sf.read(audio_file, dtype='int16')
+    except Exception as e:
+        print(f"Skipping {audio_file.name}: could not read it ({e})")
+        return None
+    if sr != REQUIRED_SAMPLE_RATE:
+        print(f"Skipping {audio_file.name}: {sr}Hz (expected {REQUIRED_SAMPLE_RATE}Hz)")
+        return None
+    if data.ndim > 1:
+        data = data[:, 0]
+    if data.size == 0:
+        return None
+
+    shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    np.ndarray(data.shape, dtype=np.int16, buffer=shm.buf)[:] = data
+    source = {
+        "name": audio_file.name,
+        "stem": audio_file.stem,
+        "shm_name": shm.name,
+        "shape": data.shape,
+        "sample_rate": sr
+    }
+    return shm, source
+
+
+def attach_source_audio(source: dict) -> np.ndarray:
+    """Maps a shared source's PCM in a worker (once per worker and file)."""
+    cached = _attached_sources.get(source["shm_name"])
+    if cached is None:
+        shm = shared_memory.SharedMemory(name=source["shm_name"])
+        pcm = np.ndarray(source["shape"], dtype=np.int16, buffer=shm.buf)
+        pcm.flags.writeable = False
+        cached = (shm, pcm)
+        _attached_sources[source["shm_name"]] = cached
+    return cached[1]
+
+def _worker_init(counter):
+    """
+    Runs once in each pool worker before it takes any jobs, so per-worker
+    setup is not repeated for every combination.
+    """
+    # One core per worker (see opus_wrapper.pin_worker)
+    pin_worker(counter)
+
+    # Suppress PESQ warnings within the worker process
+    warnings.simplefilter("ignore")
+
+    # Warm PESQ with one throwaway 1s score, so the worker's first real
+    # job does not also pay the extension's first-call page-in/setup.
+    try:
+        from pesq import pesq
+        t = np.arange(REQUIRED_SAMPLE_RATE) / REQUIRED_SAMPLE_RATE
+        tone = (np.sin(2 * np.pi * 440 * t) * 8000).astype(np.int16)
+        pesq(REQUIRED_SAMPLE_RATE, tone, tone, 'wb')
+    except Exception:
+        pass
+
+
 def run_single_combination(params: dict) -> dict | None:
     """
     This is our "worker" function. It processes ONE combination of parameters.
     It's designed to be run in a separate process.
     """
-    # Suppress PESQ warnings within the worker process
-    warnings.simplefilter("ignore")
-    
     try:
-        # --- Step 1: Process the audio ---
-        processed_file = process_audio_file(
-            input_wav_path=params["original_file"],
+        source = params["source"]
+        pcm = attach_source_audio(source)
+
+        # --- Step 1: Process the audio (decoded audio stays in memory) ---
+        processed = process_audio_pcm(
+            pcm=pcm,
+            sample_rate=source["sample_rate"],
+            name=source["stem"],
             bitrate=params["bitrate"],
             frame_size=params["frame_size"],
             complexity=params["complexity"],
             use_fec=params["use_fec"],
-            simulated_loss_perc=params["packet_loss_perc"]
+            simulated_loss_perc=params["packet_loss_perc"],
+            reuse_encoding=True,
+            return_bytes=True
         )
 
-        if not processed_file:
-            # This can happen if opusenc fails
+        if not processed:
+            # This can happen if libopus fails
             return None
 
         # --- Step 2: Analyze the quality ---
-        score = get_audio_quality(params["original_file"], processed_file)
+        _, processed_pcm = processed
+        # The SNR gate only applies here, to dataset generation, and only
+        # when its cut-offs are configured (see quality_analyzer)
+        skipped_before = skip_stats["skipped_high"] + skip_stats["skipped_low"]
+        score = get_audio_quality(pcm, processed_pcm, snr_gate=True)
+        snr_gated = skip_stats["skipped_high"] + skip_stats["skipped_low"] > skipped_before
 
         if not score:
             # This can happen if pesq fails
-            processed_file.unlink(missing_ok=True) # Clean up
             return None
 
         # --- Step 3: Create the result ---
         result_data = {
-            "original_file": params["original_file"].name,
+            "original_file": source["name"],
             "bitrate": params["bitrate"],
             "frame_size": params["frame_size"],
             "complexity": params["complexity"],
             "use_fec": params["use_fec"],
             "packet_loss_perc": params["packet_loss_perc"],
-            "pesq_mos_score": score
+            "pesq_mos_score": score,
+            # Not a dataset column; popped by the parent for the skip stats
+            "_snr_gated": snr_gated
         }
-
-        # --- Step 4: Clean up the file ---
-        processed_file.unlink(missing_ok=True)
         
         return result_data
         
@@ -108,7 +219,7 @@ def run_experiment_parallel():
     print("--- Starting Phase 1: Data Generation (Parallel) ---")
 
     # 1. Find all our clean audio files
-    audio_files = list(Path(CLEAN_AUDIO_DIR).rglob("*.flac"))
+    audio_files = list_flacs()
     if not audio_files:
         print(f"Error: No .flac files found in {CLEAN_AUDIO_DIR}")
         return
@@ -116,47 +227,104 @@ def run_experiment_parallel():
     files_to_process = audio_files[:MAX_FILES_TO_PROCESS]
     print(f"Found {len(audio_files)} total files. Processing {len(files_to_process)}.")
 
-    # 2. Create the "Job List" - all 10,080 parameter combinations
-    print("Generating job list...")
-    all_job_params = []
-    for original_file in files_to_process:
-        for bitrate in BITRATES:
-            for frame_size in FRAME_SIZES:
-                for complexity in COMPLEXITIES:
-                    for use_fec in FEC_STATUSES:
-                        for loss_perc in PACKET_LOSSES:
-                            params = {
-                                "original_file": original_file,
-                                "bitrate": bitrate,
-                                "frame_size": frame_size,
-                                "complexity": complexity,
-                                "use_fec": use_fec,
-                                "packet_loss_perc": loss_perc
-                            }
-                            all_job_params.append(params)
-
-    total_runs = len(all_job_params)
-    print(f"Total combinations to process: {total_runs}")
-
-    # 3. Run the "Job List" in Parallel
-    num_cores = multiprocessing.cpu_count()
-    print(f"Starting process pool with {num_cores} cores (you have 12)...")
-
-    results_list = []
+    # Results are streamed to the CSV as they arrive instead of being
+    # collected in memory first.
+    output_csv_path = BASE_PROJECT_DIR / "opus_dataset.csv"
+    output_parquet_path = output_csv_path.with_suffix(".parquet")
+    rows_written = 0
+    parquet_writer = None
+    shared_blocks = []
     
     try:
-        # Create the pool
-        pool = multiprocessing.Pool(processes=num_cores)
-        
-        # Use pool.imap_unordered to get results as they finish.
-        # This gives us a much more responsive progress bar.
-        jobs = pool.imap_unordered(run_single_combination, all_job_params)
-        
-        # Wrap the 'jobs' iterable with tqdm to create the progress bar
-        for result in tqdm(jobs, total=total_runs, unit="run"):
-            if result is not None:
-                results_list.append(result)
+        # 2. Decode each source file once into shared memory (inside the
+        # try, so the finally below always unlinks the blocks)
+        print("Loading source audio into shared memory...")
+        sources = []
+        for original_file in files_to_process:
+            shared = share_source_audio(original_file)
+            if shared is not None:
+                shared_blocks.append(shared[0])
+                sources.append(shared[1])
+
+        # 3. Create the "Job List" - all 10,080 parameter combinations
+        print("Generating job list...")
+        all_job_params = []
+        for source in sources:
+            for bitrate in BITRATES:
+                for frame_size in FRAME_SIZES:
+                    for complexity in COMPLEXITIES:
+                        for use_fec in FEC_STATUSES:
+                            for loss_perc in PACKET_LOSSES:
+                                params = {
+                                    "source": source,
+                                    "bitrate": bitrate,
+                                    "frame_size": frame_size,
+                                    "complexity": complexity,
+                                    "use_fec": use_fec,
+                                    "packet_loss_perc": loss_perc
+                                }
+                                all_job_params.append(params)
+
+        total_runs = len(all_job_params)
+        print(f"Total combinations to process: {total_runs}")
+
+        # 4. Run the "Job List" in Parallel
+        num_cores = multiprocessing.cpu_count()
+        print(f"Starting process pool with {num_cores} cores (you have 12)...")
+
+        with open(output_csv_path, "w", newline="") as f, shelve.open(str(SCORE_CACHE_PATH)) as score_cache:
+            writer = csv.DictWriter(f, fieldnames=DATASET_COLUMNS)
+            writer.writeheader()
+            # Same rows, columnar, for the report/training scripts
+            parquet_writer = open_parquet_writer(output_parquet_path)
+
+            def write_row(row: dict):
+                nonlocal rows_written
+                writer.writerow(row)
+                if parquet_writer is not None:
+                    parquet_writer.write(row)
+                rows_written += 1
+
+            # Copy combinations finished by an earlier run from the cache;
+            # only the rest go to the pool.
+            pending_job_params = []
+            for params in all_job_params:
+                cached = score_cache.get(
+                    combination_key({**params, "original_file": params["source"]["name"]})
+                )
+                if cached is None:
+                    pending_job_params.append(params)
+                else:
+                    write_row(cached)
+            if rows_written:
+                print(f"Reused {rows_written} cached results from {SCORE_CACHE_PATH}")
+
+            # Create the pool
+            worker_counter = multiprocessing.Value('i', 0)
+            pool = multiprocessing.Pool(
+                processes=num_cores, initializer=_worker_init, initargs=(worker_counter,)
+            )
+            
+            # Use pool.imap_unordered to get results as they finish.
+            # This gives us a much more responsive progress bar.
+            # Jobs are dispatched in chunks to amortize the IPC round-trip; the
+            # job list is ordered by (file, bitrate, ...), so each chunk mostly
+            # stays on one source file.
+            chunksize = max(1, len(pending_job_params) // (num_cores * 8))
+            computed = snr_gated = 0
+            jobs = pool.imap_unordered(run_single_combination, pending_job_params, chunksize=chunksize)
+            
+            # Wrap the 'jobs' iterable with tqdm to create the progress bar
+            for result in tqdm(jobs, total=len(pending_job_params), unit="run"):
+                if result is not None:
+                    snr_gated += result.pop("_snr_gated")
+                    computed += 1
+                    write_row(result)
+                    score_cache[combination_key(result)] = result
                 
+        if SNR_GATE_ENABLED:
+            print(f"SNR gate skipped PESQ for {snr_gated} of {computed} computed rows.")
+
         # We are done, close the pool
         pool.close()
         pool.join()
@@ -164,27 +332,86 @@ def run_experiment_parallel():
         
     except KeyboardInterrupt:
         print("\nCaught KeyboardInterrupt! Terminating workers...")
+        print(f"Partial dataset ({rows_written} rows) kept at: {output_csv_path}")
         # cleanup_pool() is already registered with atexit, so it will run
         return
     except Exception as e:
         print(f"An error occurred during parallel processing: {e}")
         # cleanup_pool() will run
         return
+    finally:
+        # Flush the last row group, so a partial run still leaves a valid file
+        if parquet_writer is not None:
+            parquet_writer.close()
+        # Release the shared source audio
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
 
     print(f"\n✅ --- Experiment Complete! ---")
 
-    # 4. Save all results to a CSV file
-    if results_list:
-        output_csv_path = BASE_PROJECT_DIR / "opus_dataset.csv"
-        df = pd.DataFrame(results_list)
-        df.to_csv(output_csv_path, index=False)
-        print(f"Successfully generated dataset with {len(df)} rows.")
+    # 5. Report on the saved dataset
+    if rows_written:
+        print(f"Successfully generated dataset with {rows_written} rows.")
         print(f"Dataset saved to: {output_csv_path}")
+        if parquet_writer is not None:
+            print(f"Parquet copy saved to: {output_parquet_path}")
     else:
+        output_csv_path.unlink(missing_ok=True)
+        output_parquet_path.unlink(missing_ok=True)
         print("No results were generated. Please check for errors.")
 
 
+class ParquetDatasetWriter:
+    """
+    Streams dataset rows into a Parquet file. Rows are buffered per column
+    and written as one zstd-compressed row group every PARQUET_ROW_GROUP_ROWS.
+    """
+
+    def __init__(self, path: Path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ("original_file", pa.string()),
+            ("bitrate", pa.int16()),
+            ("frame_size", pa.int8()),
+            ("complexity", pa.int8()),
+            ("use_fec", pa.bool_()),
+            ("packet_loss_perc", pa.float32()),
+            ("pesq_mos_score", pa.float32()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.buffer = {name: [] for name in DATASET_COLUMNS}
+
+    def write(self, row: dict):
+        for name, column in self.buffer.items():
+            column.append(row[name])
+        if len(self.buffer["original_file"]) >= PARQUET_ROW_GROUP_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.buffer["original_file"]:
+            self.writer.write_table(self.pa.table(self.buffer, schema=self.schema))
+            self.buffer = {name: [] for name in DATASET_COLUMNS}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_parquet_writer(path: Path) -> ParquetDatasetWriter | None:
+    """Returns a ParquetDatasetWriter for path, or None if pyarrow is not installed."""
+    # Never leave a Parquet file from an older run next to the new CSV
+    path.unlink(missing_ok=True)
+    try:
+        return ParquetDatasetWriter(path)
+    except ImportError:
+        return None
+
+
 if __name__ == "__main__":
     # This is necessary for multiprocessing to work correctly on some systems
     multiprocessing.freeze_support() 
-    run_experiment_parallel()
\ No newline at end of file
+    run_experiment_parallel()
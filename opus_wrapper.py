@@ -1,6 +1,17 @@
-import subprocess
 import os
+import functools
+import ctypes
+import multiprocessing
+import wave
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import numpy as np
+import soundfile as sf
+import opuslib
+import opuslib.api.ctl as opus_ctl
+import opuslib.api.encoder as encoder_api
+import opuslib.api.decoder as decoder_api
 
 # --- Configuration ---
 # These paths are inside your WSL2 environment.
@@ -9,18 +20,239 @@ BASE_PROJECT_DIR = Path.home() / "adaptive_opus"
 CLEAN_AUDIO_DIR = BASE_PROJECT_DIR / "clean_audio"
 PROCESSED_AUDIO_DIR = BASE_PROJECT_DIR / "processed_audio"
 
+# Decoder output rate. The original LibriSpeech files are 16kHz, and the
+# 'pesq' library requires either 8kHz or 16kHz.
+DECODE_SAMPLE_RATE = 16000
+
+# Upper bound for one encoded Opus packet (libopus recommendation)
+MAX_PACKET_BYTES = 4000
+# Input rates libopus can encode directly
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
 # Ensure the processed audio directory exists
 PROCESSED_AUDIO_DIR.mkdir(parents=True, exist_ok=True)
 
 
+def _scan_flacs(directory: str) -> list[str]:
+    found = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                found.extend(_scan_flacs(entry.path))
+            elif entry.name.endswith(".flac"):
+                found.append(entry.path)
+    return found
+
+
+@functools.cache
+def list_flacs() -> list[Path]:
+    """
+    Returns every .flac file under CLEAN_AUDIO_DIR, sorted. The tree is
+    walked once per process; later calls reuse the list.
+    """
+    if not CLEAN_AUDIO_DIR.is_dir():
+        return []
+    return [Path(f) for f in sorted(_scan_flacs(str(CLEAN_AUDIO_DIR)))]
+
+def _output_filename_base(
+    name: str,
+    bitrate: int,
+    frame_size: int,
+    complexity: int,
+    use_fec: bool,
+    simulated_loss_perc: float
+) -> str:
+    # Example: original_file_b32_f20_c10_fec_l5
+    fec_str = "fec" if use_fec else "nofec"
+    loss_str = str(simulated_loss_perc).replace('.', 'p')
+    return (
+        f"{name}_"
+        f"b{bitrate}_f{frame_size}_c{complexity}_"
+        f"{fec_str}_l{loss_str}"
+    )
+
+
+# One encoder per input rate and one decoder, created on first use and
+# reset between runs, so a worker process only initialises libopus once.
+_opus_encoders = {}
+_opus_decoder = None
+_opus_scratch = (ctypes.c_char * MAX_PACKET_BYTES)()
+
+
+def _libopus_encode(
+    pcm: np.ndarray,
+    sample_rate: int,
+    bitrate: int,
+    frame_size: int,
+    complexity: int,
+    use_fec: bool
+) -> tuple[list, int]:
+    """
+    Encodes mono int16 PCM with libopus. Returns the packets and the
+    encoder lookahead in samples.
+    """
+    encoder = _opus_encoders.get(sample_rate)
+    if encoder is None:
+        encoder = opuslib.Encoder(sample_rate, 1, opuslib.APPLICATION_AUDIO)
+        _opus_encoders[sample_rate] = encoder
+    else:
+        encoder_api.encoder_ctl(encoder.encoder_state, opus_ctl.reset_state)
+    encoder.bitrate = bitrate * 1000
+    encoder.complexity = complexity
+    # FEC tuned for an expected 5% loss
+    encoder_api.encoder_ctl(encoder.encoder_state, opus_ctl.set_inband_fec, 1 if use_fec else 0)
+    encoder.packet_loss_perc = 5 if use_fec else 0
+    lookahead = encoder.lookahead
+
+    frame_samples = sample_rate * frame_size // 1000
+    num_frames = -(-len(pcm) // frame_samples)
+    # Zero-pad the last frame, plus one more frame to flush the lookahead
+    padded = np.zeros((num_frames + 1) * frame_samples, dtype=np.int16)
+    padded[:len(pcm)] = pcm
+    base = padded.ctypes.data
+
+    packets = []
+    for i in range(num_frames + 1):
+        pcm_pointer = ctypes.cast(base + i * frame_samples * 2, opuslib.api.c_int16_pointer)
+        result = encoder_api.libopus_encode(
+            encoder.encoder_state, pcm_pointer, frame_samples, _opus_scratch, MAX_PACKET_BYTES
+        )
+        if result < 0:
+            raise opuslib.OpusError(result)
+        packets.append(ctypes.string_at(_opus_scratch, result))
+    return packets, lookahead
+
+
+def _libopus_decode(
+    packets: list,
+    lookahead: int,
+    sample_rate: int,
+    num_samples: int,
+    frame_size: int,
+    simulated_loss_perc: float,
+    seed: int | None
+) -> np.ndarray:
+    """
+    Decodes packets at DECODE_SAMPLE_RATE, dropping simulated_loss_perc of
+    them at random (reproducibly for a given seed). A lost packet is rebuilt
+    from the next packet's FEC data when that packet arrived, otherwise by
+    concealment.
+    """
+    global _opus_decoder
+    if _opus_decoder is None:
+        _opus_decoder = opuslib.Decoder(DECODE_SAMPLE_RATE, 1)
+    else:
+        decoder_api.decoder_ctl(_opus_decoder.decoder_state, opus_ctl.reset_state)
+    state = _opus_decoder.decoder_state
+
+    frame_samples = DECODE_SAMPLE_RATE * frame_size // 1000
+    lost = np.random.default_rng(seed).random(len(packets)) * 100 < simulated_loss_perc
+    out = np.zeros(len(packets) * frame_samples, dtype=np.int16)
+    base = out.ctypes.data
+
+    for i, packet in enumerate(packets):
+        pcm_pointer = ctypes.cast(base + i * frame_samples * 2, opuslib.api.c_int16_pointer)
+        decode_fec = 0
+        if lost[i]:
+            packet = None
+            if i + 1 < len(packets) and not lost[i + 1]:
+                packet, decode_fec = packets[i + 1], 1
+        result = decoder_api.libopus_decode(
+            state, packet, len(packet) if packet else 0, pcm_pointer, frame_samples, decode_fec
+        )
+        if result < 0:
+            raise opuslib.OpusError(result)
+
+    # Drop the encoder delay so the output lines up with the input
+    skip = lookahead * DECODE_SAMPLE_RATE // sample_rate
+    length = num_samples * DECODE_SAMPLE_RATE // sample_rate
+    return out[skip:skip + length]
+
+
+def _write_wav(path: Path, samples: np.ndarray):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(DECODE_SAMPLE_RATE)
+        f.writeframes(samples.astype('<i2', copy=False).tobytes())
+
+
+def loss_seed(name: str, frame_size: int) -> int:
+    """
+    Packet-loss seed for one source and frame size. It deliberately ignores
+    the other codec settings and the loss level: the same uniform draws are
+    thresholded against simulated_loss_perc, so runs that differ only in
+    bitrate, complexity or FEC lose exactly the same packets, and a higher
+    loss level drops a superset of a lower one. (crc32 rather than hash(),
+    which is salted per interpreter.)
+    """
+    return zlib.crc32(f"{name}|{frame_size}".encode())
+
+
+def opus_roundtrip(
+    pcm: np.ndarray,
+    sample_rate: int,
+    bitrate: int,
+    frame_size: int,
+    complexity: int,
+    use_fec: bool,
+    simulated_loss_perc: float,
+    cache_name: str | None = None,
+    seed: int | None = None
+) -> np.ndarray:
+    """
+    Encodes mono int16 PCM with libopus and decodes it again with simulated
+    packet loss, all in-process. Returns the decoded samples at
+    DECODE_SAMPLE_RATE, aligned with the input. Raises opuslib.OpusError.
+
+    With cache_name, the encoded packets are kept and reused for later
+    calls with the same name and encoder settings (see _encode_cached).
+    seed fixes which packets are lost; None draws a fresh pattern.
+    """
+    if cache_name is not None:
+        packets, lookahead = _encode_cached(
+            cache_name, (bitrate, frame_size, complexity, use_fec),
+            lambda: _libopus_encode(pcm, sample_rate, bitrate, frame_size, complexity, use_fec)
+        )
+    else:
+        packets, lookahead = _libopus_encode(pcm, sample_rate, bitrate, frame_size, complexity, use_fec)
+    return _libopus_decode(packets, lookahead, sample_rate, len(pcm), frame_size, simulated_loss_perc, seed)
+
+
+# Encoded packets for the source currently being swept, keyed by encoder
+# settings. Packet loss is only applied at decode time, so every loss
+# level of a sweep reuses one encode. At most 72 entries (one source).
+_encoded_cache = {}
+_encoded_cache_source = None
+
+
+def _encode_cached(input_name: str, key: tuple, encode):
+    """
+    Returns encode() for this source and encoder settings, reusing the
+    result of an earlier call. Only the latest source is kept.
+    """
+    global _encoded_cache_source
+    if input_name != _encoded_cache_source:
+        _encoded_cache.clear()
+        _encoded_cache_source = input_name
+
+    encoded = _encoded_cache.get(key)
+    if encoded is None:
+        encoded = encode()
+        if encoded is not None:
+            _encoded_cache[key] = encoded
+    return encoded
+
+
 def process_audio_file(
     input_wav_path: Path,
     bitrate: int,
     frame_size: int,
     complexity: int,
     use_fec: bool,
-    simulated_loss_perc: float
-) -> Path | None:
+    simulated_loss_perc: float,
+    return_bytes: bool = False
+) -> Path | tuple[int, np.ndarray] | None:
     """
     Runs a single audio file through the full Opus encode/decode pipeline
     to simulate network conditions and codec settings.
@@ -32,101 +264,150 @@ def process_audio_file(
         complexity: Encoder complexity (0-10, 10 is best).
         use_fec: Boolean. If True, tells the encoder to expect loss (enables FEC).
         simulated_loss_perc: The percentage of packets to *actually* drop (0-100).
+        return_bytes: If True, skip the output .wav and return the decoded
+            audio in memory instead.
 
     Returns:
-        The path to the final decoded (and damaged) .wav file, or None if an error occurred.
+        The path to the final decoded (and damaged) .wav file, or with
+        return_bytes a (sample_rate, int16 samples) tuple; None if an error occurred.
     """
-    
-    # 1. Create a unique filename for this processing run
-    # Example: original_file_b32_f20_c10_fec_l5.wav
-    fec_str = "fec" if use_fec else "nofec"
-    loss_str = str(simulated_loss_perc).replace('.', 'p')
-    
-    output_filename_base = (
-        f"{input_wav_path.stem}_"
-        f"b{bitrate}_f{frame_size}_c{complexity}_"
-        f"{fec_str}_l{loss_str}"
+    try:
+        pcm, sample_rate = sf.read(input_wav_path, dtype='int16')
+    except Exception as e:
+        print(f"Error reading audio file: {input_wav_path}")
+        print(f"Error: {e}")
+        return None
+    if pcm.ndim > 1:
+        pcm = pcm[:, 0]
+
+    return process_audio_pcm(
+        pcm, sample_rate, input_wav_path.stem,
+        bitrate, frame_size, complexity, use_fec, simulated_loss_perc,
+        return_bytes=return_bytes
     )
-    
-    # Define the intermediate and final file paths
-    # We use .opus for the intermediate compressed file
-    intermediate_opus_file = PROCESSED_AUDIO_DIR / f"{output_filename_base}.opus"
-    # And .wav for the final, decoded (damaged) file
-    final_wav_file = PROCESSED_AUDIO_DIR / f"{output_filename_base}.wav"
 
-    # --- 2. Step 2: ENCODE (Clean .wav -> Compressed .opus) ---
-    
-    # Set the --expect-loss flag if FEC is requested.
-    # This tells the encoder to add redundant data (FEC) to the stream.
-    fec_flag = ["--expect-loss", "5"] if use_fec else [] # '5' is a reasonable default guess for FEC
-    
-    encode_command = [
-        "opusenc",
-        "--bitrate", str(bitrate),
-        "--framesize", str(frame_size),
-        "--comp", str(complexity),
-        *fec_flag,
-        str(input_wav_path),
-        str(intermediate_opus_file)
-    ]
 
-    try:
-        # Run the command. check=True means it will raise an error if opusenc fails
-        subprocess.run(encode_command, check=True, capture_output=True, text=True)
-    
-    except subprocess.CalledProcessError as e:
-        print(f"Error during ENCODING. File: {input_wav_path.name}")
-        print(f"Command: {' '.join(e.cmd)}")
-        print(f"Stderr: {e.stderr}")
+def process_audio_pcm(
+    pcm: np.ndarray,
+    sample_rate: int,
+    name: str,
+    bitrate: int,
+    frame_size: int,
+    complexity: int,
+    use_fec: bool,
+    simulated_loss_perc: float,
+    reuse_encoding: bool = False,
+    return_bytes: bool = False,
+    loss_name: str | None = None
+) -> Path | tuple[int, np.ndarray] | None:
+    """
+    Same pipeline as process_audio_file(), but takes clean audio that is
+    already decoded in memory, so no source file is read.
+
+    Args:
+        pcm: Mono int16 samples.
+        sample_rate: Sample rate of pcm in Hz (8, 12, 16, 24 or 48 kHz).
+        name: Name used for the output file (like a file stem). Together
+            with frame_size it also seeds the packet loss (see loss_seed).
+        (bitrate ... simulated_loss_perc as in process_audio_file)
+        reuse_encoding: If True, keep the encoded packets in memory and reuse
+            them for later calls with the same name and encoder settings
+            (e.g. a sweep over packet loss). name must identify the audio.
+        return_bytes: As in process_audio_file.
+        loss_name: Seeds the packet loss instead of name, so runs with
+            different output names can share one loss pattern.
+
+    Returns:
+        The path to the final decoded (and damaged) .wav file, or with
+        return_bytes a (sample_rate, int16 samples) tuple; None if an error occurred.
+    """
+    output_filename_base = _output_filename_base(
+        name, bitrate, frame_size, complexity, use_fec, simulated_loss_perc
+    )
+
+    if sample_rate not in OPUS_SAMPLE_RATES:
+        print(f"Error: libopus cannot encode {sample_rate}Hz audio. File: {name}")
         return None
 
-    # --- 3. Step 3: DECODE (Compressed .opus -> Damaged .wav) ---
-    
-    # Set the --packet-loss flag.
-    # This tells the decoder to *simulate* random packet loss.
-    
-    # ***** NEW (AND CRITICAL) *****
-    # We force the output sample rate to 16000 Hz.
-    # The original LibriSpeech files are 16kHz, and the 'pesq'
-    # library requires either 8kHz or 16kHz. This ensures both
-    # original and processed files match.
-    
-    decode_command = [
-        "opusdec",
-        "--rate", "16000",  # <--- ADD THIS LINE
-        "--packet-loss", str(simulated_loss_perc),
-        str(intermediate_opus_file),
-        str(final_wav_file)
-    ]
-    
     try:
-        subprocess.run(decode_command, check=True, capture_output=True, text=True)
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error during DECODING. File: {intermediate_opus_file.name}")
-        print(f"Command: {' '.join(e.cmd)}")
-        print(f"Stderr: {e.stderr}")
-        # Clean up the intermediate file if decoding fails
-        intermediate_opus_file.unlink(missing_ok=True)
+        samples = opus_roundtrip(
+            np.ascontiguousarray(pcm, dtype=np.int16), sample_rate,
+            bitrate, frame_size, complexity, use_fec, simulated_loss_perc,
+            cache_name=name if reuse_encoding else None,
+            seed=loss_seed(loss_name or name, frame_size)
+        )
+    except opuslib.OpusError as e:
+        print(f"Error during libopus ENCODE/DECODE. File: {name}")
+        print(f"Error: {e}")
         return None
 
-    # --- 4. Step 4: Clean up intermediate file ---
-    intermediate_opus_file.unlink(missing_ok=True)
-    
+    if return_bytes:
+        return DECODE_SAMPLE_RATE, samples
+    final_wav_file = PROCESSED_AUDIO_DIR / f"{output_filename_base}.wav"
+    _write_wav(final_wav_file, samples)
     # Return the path to the final, processed .wav file
     return final_wav_file
 
 
+def pin_worker(counter):
+    """
+    Pool initializer that pins each worker process to its own core, so the
+    codec state stays in that core's caches instead of migrating.
+
+    counter is a shared multiprocessing.Value('i', 0); each worker takes the
+    next index from it. Also caps the BLAS/OpenMP thread pools at one thread
+    per worker, since the pool already has one process per core.
+    """
+    # The worker is forked after numpy is loaded, so its thread pools are
+    # already sized; environment variables would only reach libraries
+    # loaded later. threadpoolctl (a scikit-learn dependency) resizes them.
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        threadpool_limits(1)
+
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+
+    if hasattr(os, "sched_setaffinity"):  # Linux only
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[worker_id % len(cores)]})
+
+
+def _run_one(job: dict) -> Path | None:
+    return process_audio_file(**job)
+
+
+def process_audio_batch(jobs: list[dict], max_workers: int | None = None, chunksize: int = 4) -> list[Path | None]:
+    """
+    Runs many process_audio_file() jobs in parallel, one process per core.
+    Each job is a dict of process_audio_file() keyword arguments; each
+    libopus round trip is single-threaded, so this scales with cores.
+
+    Returns:
+        The process_audio_file() results, in the same order as jobs.
+    """
+    if not jobs:
+        return []
+    workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    counter = multiprocessing.Value('i', 0)
+    with ProcessPoolExecutor(max_workers=workers, initializer=pin_worker, initargs=(counter,)) as ex:
+        return list(ex.map(_run_one, jobs, chunksize=chunksize))
+
+
 if __name__ == "__main__":
     # This is a test block to see if our function works.
     print("--- Running test on opus_wrapper.py ---")
     
     # 1. Find the first .flac file in our clean_audio directory to use for testing
-    # LibriSpeech uses .flac, but opus-tools can read them directly!
+    # LibriSpeech uses .flac, which soundfile reads directly
     try:
-        test_file = next(Path(CLEAN_AUDIO_DIR).rglob("*.flac"))
+        test_file = list_flacs()[0]
         print(f"Found test file: {test_file}")
-    except StopIteration:
+    except IndexError:
         print("Error: Could not find any .flac files in ./clean_audio/LibriSpeech/")
         print("Please make sure you ran Step 4 from the setup instructions.")
         exit()
@@ -2,25 +2,77 @@ import soundfile as sf
 import numpy as np
 from pesq import pesq
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import os
 import warnings
 
 # --- Configuration ---
 # Import the same directory settings from our wrapper
-from opus_wrapper import CLEAN_AUDIO_DIR, PROCESSED_AUDIO_DIR, process_audio_file
+from opus_wrapper import PROCESSED_AUDIO_DIR, list_flacs, process_audio_file
 
 # Define the sample rate we are using. PESQ 'wb' mode requires 16kHz.
 REQUIRED_SAMPLE_RATE = 16000
 PESQ_MODE = 'wb' # 'wb' = Wideband (for 16kHz)
 
-
-def get_audio_quality(original_file_path: Path, processed_file_path: Path) -> float | None:
+# Optional SNR gate in front of PESQ (get_audio_quality(..., snr_gate=True),
+# used by the dataset sweep): above SNR_SKIP_HIGH_DB the degraded signal is
+# scored PESQ_CEILING without running PESQ; below SNR_SKIP_LOW_DB it is
+# scored 1.0. Both cut-offs are off unless set in the environment: waveform
+# SNR is a poor proxy for PESQ on Opus output (a 440 Hz tone at 48 kbps
+# measures 38.7 dB but scores 3.97), so calibrate them against PESQ on
+# your own data before enabling either.
+SNR_SKIP_HIGH_DB = float(os.environ.get("PESQ_SKIP_SNR_HIGH_DB", "inf"))
+SNR_SKIP_LOW_DB = float(os.environ.get("PESQ_SKIP_SNR_LOW_DB", "-inf"))
+SNR_GATE_ENABLED = SNR_SKIP_HIGH_DB != float("inf") or SNR_SKIP_LOW_DB != float("-inf")
+# Highest score wideband PESQ (P.862.2) can produce
+PESQ_CEILING = 4.644
+
+# Per-process count of how each score was produced
+skip_stats = {"pesq": 0, "skipped_high": 0, "skipped_low": 0}
+
+
+@functools.lru_cache(maxsize=256)
+def _load_ref_int16(path_str: str) -> tuple[int, np.ndarray]:
+    """
+    Loads a reference file as mono int16, once per file: a parameter sweep
+    scores the same clean file against many processed versions.
+    The returned array is shared between callers, so it is read-only.
+    """
+    data, fs = sf.read(path_str, dtype='int16')
+    if data.ndim > 1:
+        data = data[:, 0]
+    data = np.ascontiguousarray(data)
+    data.flags.writeable = False
+    return fs, data
+
+
+def _snr_db(ref: np.ndarray, deg: np.ndarray) -> float:
+    """Waveform SNR of deg against ref (equal-length mono int16), in dB."""
+    ref = ref.astype(np.int64)
+    d = ref - deg
+    noise = max(1, int(np.dot(d, d)))
+    return 10 * np.log10(max(1, int(np.dot(ref, ref))) / noise)
+
+
+def get_audio_quality(
+    original_file_path: Path | np.ndarray,
+    processed_file_path: Path | np.ndarray,
+    snr_gate: bool = False
+) -> float | None:
     """
     Compares an original (clean) audio file against a processed (damaged)
     file and returns the PESQ score.
 
+    Either argument may also be already-decoded int16 samples (at
+    REQUIRED_SAMPLE_RATE), which skips reading that side from disk.
+
     Args:
         original_file_path: Path to the clean, original .flac or .wav file.
         processed_file_path: Path to the decoded, processed .wav file.
+        snr_gate: If True, skip PESQ when the waveform SNR is outside the
+            SNR_SKIP_LOW_DB..SNR_SKIP_HIGH_DB band (see above; a no-op
+            unless one of the cut-offs is configured).
 
     Returns:
         The PESQ MOS score (float, typically 1.0 to 4.5), or None if an error occurred.
@@ -29,10 +81,20 @@ def get_audio_quality(original_file_path: Path, processed_file_path: Path) -> fl
     try:
         # 1. Load the original (reference) audio file
         # We use soundfile, which can handle .flac
-        ref_data, ref_fs = sf.read(original_file_path, dtype='int16')
+        if isinstance(original_file_path, np.ndarray):
+            ref_data, ref_fs = original_file_path, REQUIRED_SAMPLE_RATE
+        else:
+            ref_fs, ref_data = _load_ref_int16(str(original_file_path))
         
-        # 2. Load the processed (degraded) audio file
-        deg_data, deg_fs = sf.read(processed_file_path, dtype='int16')
+        # 2. Load the processed (degraded) audio file. Only the samples
+        # that line up with the reference are read; the rest is trimmed anyway.
+        if isinstance(processed_file_path, np.ndarray):
+            deg_data, deg_fs = processed_file_path, REQUIRED_SAMPLE_RATE
+        else:
+            with sf.SoundFile(processed_file_path) as deg_file:
+                deg_fs = deg_file.samplerate
+                frames = min(deg_file.frames, ref_data.shape[0])
+                deg_data = deg_file.read(frames, dtype='int16')
 
     except Exception as e:
         print(f"Error reading audio files: {e}")
@@ -41,25 +103,32 @@ def get_audio_quality(original_file_path: Path, processed_file_path: Path) -> fl
     # 3. Validate sample rates
     if ref_fs != REQUIRED_SAMPLE_RATE or deg_fs != REQUIRED_SAMPLE_RATE:
         print(f"Error: Files do not have the required {REQUIRED_SAMPLE_RATE}Hz sample rate.")
-        print(f"  Reference: {original_file_path.name} is {ref_fs}Hz")
-        print(f"  Degraded: {processed_file_path.name} is {deg_fs}Hz")
-        print("  (Did you add '--rate 16000' to opus_wrapper.py?)")
+        print(f"  Reference: {getattr(original_file_path, 'name', '<in-memory>')} is {ref_fs}Hz")
+        print(f"  Degraded: {getattr(processed_file_path, 'name', '<in-memory>')} is {deg_fs}Hz")
+        print(f"  (opus_wrapper decodes at DECODE_SAMPLE_RATE; it must be {REQUIRED_SAMPLE_RATE}Hz)")
         return None
 
-    # 4. Ensure audio is mono (PESQ expects 1D array)
-    # Our VoIP use case is mono.
-    if ref_data.ndim > 1:
-        ref_data = ref_data[:, 0]
-    if deg_data.ndim > 1:
-        deg_data = deg_data[:, 0]
-        
-    # 5. Ensure files are the same length (pad the shorter one)
-    # This is common as encoding/decoding can add/remove a few samples
-    min_len = min(len(ref_data), len(deg_data))
-    ref_data = ref_data[:min_len]
-    deg_data = deg_data[:min_len]
-
-    # 6. Calculate PESQ score
+    # 4./5. Ensure audio is mono (PESQ expects 1D array) and both signals
+    # are the same length (trim the longer one): encoding/decoding can
+    # add/remove a few samples. Our VoIP use case is mono.
+    # One slice per signal; ascontiguousarray only copies for the strided
+    # first channel of a stereo file.
+    min_len = min(ref_data.shape[0], deg_data.shape[0])
+    ref_data = np.ascontiguousarray(ref_data[:min_len, 0] if ref_data.ndim > 1 else ref_data[:min_len])
+    deg_data = np.ascontiguousarray(deg_data[:min_len, 0] if deg_data.ndim > 1 else deg_data[:min_len])
+
+    # 6. Optionally skip PESQ when a cheap SNR check already decides the score
+    if snr_gate and SNR_GATE_ENABLED:
+        snr = _snr_db(ref_data, deg_data)
+        if snr > SNR_SKIP_HIGH_DB:
+            skip_stats["skipped_high"] += 1
+            return PESQ_CEILING
+        if snr < SNR_SKIP_LOW_DB:
+            skip_stats["skipped_low"] += 1
+            return 1.0
+    skip_stats["pesq"] += 1
+
+    # 7. Calculate PESQ score
     try:
         # Suppress warnings from the PESQ library if it encounters bad audio
         with warnings.catch_warnings():
@@ -74,15 +143,39 @@ def get_audio_quality(original_file_path: Path, processed_file_path: Path) -> fl
         return 1.0
 
 
+def _score_pair(pair: tuple) -> float | None:
+    return get_audio_quality(*pair)
+
+
+def score_batch(pairs: list[tuple[Path, Path]], workers: int | None = None) -> list[float | None]:
+    """
+    Scores many (original, processed) pairs in parallel on a process pool.
+    The pesq extension holds the GIL for the whole measurement, so threads
+    would score one pair at a time. (pesq.pesq_batch needs equal-length
+    signals, which a sweep over different source files does not have.)
+    Pairs are handed out in contiguous chunks, so pairs that share a
+    reference mostly land in the same worker and hit its reference cache.
+
+    Returns:
+        The get_audio_quality() results, in the same order as pairs.
+    """
+    if not pairs:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(pairs))
+    chunksize = max(1, len(pairs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(_score_pair, pairs, chunksize=chunksize))
+
+
 if __name__ == "__main__":
     # This is a test block to see if our full pipeline works
     print("--- Running test on quality_analyzer.py ---")
 
     # 1. Find a test file
     try:
-        original_test_file = next(Path(CLEAN_AUDIO_DIR).rglob("*.flac"))
+        original_test_file = list_flacs()[0]
         print(f"Found original file: {original_test_file}")
-    except StopIteration:
+    except IndexError:
         print("Error: Could not find any .flac files in ./clean_audio/LibriSpeech/")
         exit()
 
@@ -137,4 +230,4 @@ if __name__ == "__main__":
             
     # Clean up test files
     processed_file.unlink(missing_ok=True)
-    processed_file_fec.unlink(missing_ok=True)
\ No newline at end of file
+    processed_file_fec.unlink(missing_ok=True)
@@ -3,7 +3,7 @@ from pathlib import Path
 import joblib  # We use joblib to save the model
 
 from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.metrics import mean_squared_error, r2_score
 
 
@@ -11,17 +11,54 @@ from sklearn.metrics import mean_squared_error, r2_score
 BASE_PROJECT_DIR = Path.home() / "adaptive_opus"
 DATASET_PATH = BASE_PROJECT_DIR / "opus_dataset.csv"
 MODEL_OUTPUT_PATH = BASE_PROJECT_DIR / "qoe_model.joblib"
+PARQUET_PATH = DATASET_PATH.with_suffix(".parquet")
+ONNX_OUTPUT_PATH = MODEL_OUTPUT_PATH.with_suffix(".onnx")
+
+# Only the columns the model uses, with fixed dtypes, so the readers skip
+# type inference and never materialise the filename strings.
+DATASET_DTYPES = {
+    'bitrate': 'int16',
+    'frame_size': 'int8',
+    'use_fec': 'bool',
+    'packet_loss_perc': 'float32',
+    'pesq_mos_score': 'float32',
+}
+
+
+def load_dataset():
+    """
+    Loads the training columns of the dataset. Prefers the Parquet copy
+    written by main_script.py, then pyarrow's multi-threaded CSV reader,
+    and finally falls back to pandas' C parser.
+    """
+    columns = list(DATASET_DTYPES)
+    try:
+        import pyarrow.csv as pv
+    except ImportError:
+        return pd.read_csv(DATASET_PATH, usecols=columns, dtype=DATASET_DTYPES, engine='c')
+
+    if PARQUET_PATH.exists():
+        return pd.read_parquet(PARQUET_PATH, columns=columns).astype(DATASET_DTYPES)
+
+    table = pv.read_csv(
+        DATASET_PATH,
+        convert_options=pv.ConvertOptions(
+            include_columns=columns,
+            column_types=DATASET_DTYPES,
+        ),
+    )
+    return table.to_pandas()
 
 
 def train_model():
     """
-    Loads the dataset, trains a Random Forest model, and saves it.
+    Loads the dataset, trains a gradient-boosted tree model, and saves it.
     """
     print("--- Starting Phase 2: Model Training ---")
 
     # 1. Load Data
     try:
-        df = pd.read_csv(DATASET_PATH)
+        df = load_dataset()
     except FileNotFoundError:
         print(f"Error: Dataset not found at {DATASET_PATH}")
         print("Please run main_script.py first to generate the dataset.")
@@ -31,15 +68,10 @@ def train_model():
 
     # 2. Pre-process Data (Feature Engineering)
     
-    # Create a copy to avoid warnings
-    df_processed = df.copy()
-    
     # Convert 'use_fec' (True/False) to a number (1/0)
     # This is required for the ML model
-    df_processed['use_fec'] = df_processed['use_fec'].astype(int)
-    
-    # We can drop columns we don't need for the model
-    df_processed = df_processed.drop(columns=['original_file', 'complexity'])
+    df['use_fec'] = df['use_fec'].astype('int8')
+    df_processed = df
 
     # 3. Define Features (X) and Target (y)
     # The model learns to predict 'y' using the features in 'X'
@@ -64,12 +96,16 @@ def train_model():
     print(f"Splitting data: {len(X_train)} training samples, {len(X_test)} testing samples.")
 
     # 5. Initialize and Train the Model
-    print("Training Random Forest Regressor...")
+    print("Training Histogram Gradient Boosting Regressor...")
     
-    # n_estimators = number of "trees" in the forest. 100 is a good default.
+    # Features are binned into small integer histograms (like LightGBM), so
+    # fitting is much faster and the saved model much smaller than a
+    # 100-tree Random Forest, and predictions are cheaper for the controller.
+    # max_iter = number of boosting rounds (trees), each with <= 31 leaves.
     # random_state=42 makes the model's "randomness" reproducible
-    # n_jobs=-1 uses all available CPU cores to speed up training
-    model = RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=-1)
+    model = HistGradientBoostingRegressor(
+        max_iter=200, max_leaf_nodes=31, learning_rate=0.08, random_state=42
+    )
     
     # The 'fit' command is where the model does all its learning
     model.fit(X_train, y_train)
@@ -92,11 +128,42 @@ def train_model():
     print("  (R² should be as close to 1.0 as possible)")
     
     # 7. Save the Trained Model
-    joblib.dump(model, MODEL_OUTPUT_PATH)
+    # zlib ships with Python, so the dashboard can load the file on any
+    # install; lz4 would need an extra package to read it back.
+    joblib.dump(model, MODEL_OUTPUT_PATH, compress=('zlib', 3))
     print(f"\n✅ --- Model Saved! ---")
     print(f"The trained model is saved to: {MODEL_OUTPUT_PATH}")
     print("This file is your 'ML-Based Adaptive Controller'.")
 
+    # 8. Export to ONNX for fast runtime inference
+    export_onnx(model, len(feature_names))
+
+
+def export_onnx(model, num_features: int):
+    """
+    Saves an ONNX copy of the model. The dashboard prefers it (through
+    onnxruntime's C++ tree kernels) when onnxruntime is installed.
+    Skipped if skl2onnx is not installed.
+    """
+    # Never leave an ONNX file from an older model for the dashboard to load
+    ONNX_OUTPUT_PATH.unlink(missing_ok=True)
+
+    try:
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        print("skl2onnx not installed; skipping ONNX export.")
+        return
+
+    try:
+        onx = convert_sklearn(model, initial_types=[('X', FloatTensorType([None, num_features]))])
+        ONNX_OUTPUT_PATH.write_bytes(onx.SerializeToString())
+    except Exception as e:
+        print(f"ONNX export failed ({e}); the dashboard will use the joblib model.")
+        ONNX_OUTPUT_PATH.unlink(missing_ok=True)
+        return
+    print(f"ONNX model saved to: {ONNX_OUTPUT_PATH}")
+
 
 if __name__ == "__main__":
     train_model()
\ No newline at end of file